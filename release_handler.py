@@ -2,15 +2,18 @@
 
 import os
 import re
-import requests
-import subprocess
 import json
 import sys
 import logging
 import argparse
-from typing import List, Dict, Tuple
-from semantic_version import Version
-from dotenv import load_dotenv
+import time
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Dict, Tuple, Iterable, Iterator
+
+if TYPE_CHECKING:
+    import pygit2
 
 # Set up logging
 logging.basicConfig(
@@ -20,11 +23,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
+STORY_ID_PATTERN = re.compile(rb'sc-(\d+)', re.IGNORECASE)
+
+# Conventional Commits prefixes and the Shortcut story type they imply
+COMMIT_TYPE_PATTERN = re.compile(rb'(feat|fix|chore)[(:!]', re.IGNORECASE)
+COMMIT_STORY_TYPES = {b'feat': 'feature', b'fix': 'bug', b'chore': 'chore'}
+
+VERSION_PATTERN = re.compile(r'v?(\d+)\.(\d+)\.(\d+)')
+VERSION_TAG_PATTERN = re.compile(r'v\d+\.\d+\.\d+')
+
+
+def parse_version(version: str) -> Tuple[int, int, int]:
+    """Parse a vMAJOR.MINOR.PATCH string into its numeric parts."""
+    match = VERSION_PATTERN.fullmatch(version)
+    if not match:
+        raise ValueError(f"Invalid version: {version}")
+    major, minor, patch = map(int, match.groups())
+    return major, minor, patch
+
+
+def bump_version(version: Tuple[int, int, int], bump_type: str) -> Tuple[int, int, int]:
+    """Increment a parsed version by the given bump type (minor or patch)."""
+    major, minor, patch = version
+    if bump_type == 'minor':
+        return major, minor + 1, 0
+    return major, minor, patch + 1
+
+
+def format_version(version: Tuple[int, int, int]) -> str:
+    """Format a parsed version as a vMAJOR.MINOR.PATCH tag."""
+    return 'v{}.{}.{}'.format(*version)
+
 
 class ReleaseHandler:
+    STORY_TYPES = ('feature', 'bug', 'chore')
+
     def __init__(self):
+        # Load environment variables
+        if os.path.exists('.env'):
+            from dotenv import load_dotenv
+            load_dotenv('.env')
+
         self.shortcut_token = os.getenv('SHORTCUT_API_TOKEN')
         if not self.shortcut_token:
             logger.error("SHORTCUT_API_TOKEN environment variable is not set")
@@ -34,71 +73,237 @@ class ReleaseHandler:
             'Content-Type': 'application/json',
             'Shortcut-Token': self.shortcut_token
         }
-        self.shortcut_api_url = 'https://api.app.shortcut.com/api/v3'
+        self.shortcut_base_url = 'https://api.app.shortcut.com'
+        self.shortcut_api_url = f'{self.shortcut_base_url}/api/v3'
+        self.search_page_size = 25
+
+        max_commits = os.getenv('SHORTCUT_MAX_COMMITS')
+        self.max_commits = int(max_commits) if max_commits else None
+
+        # Stories are cached on disk so reruns of the action don't refetch them
+        self.cache_dir = Path(os.getenv('SHORTCUT_CACHE_DIR', Path.home() / '.cache' / 'shortcut-release'))
+        self.cache_ttl = 3600
+
+        # Imported here so argument errors and --help don't pay for loading requests
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Reuse connections across story fetches, sized to match the fetch thread pool
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+
+    def _open_repository(self, repo_path: str = None) -> 'pygit2.Repository':
+        """Open the git repository containing repo_path (or the working directory)."""
+        import pygit2
+
+        return pygit2.Repository(pygit2.discover_repository(repo_path or '.'))
+
+    def _walk_commits(self, base: str, head: str, repo_path: str = None, max_count: int = None) -> Iterator['pygit2.Commit']:
+        """Walk the commits reachable from head but not base, in-process via libgit2.
+
+        Merge commits are skipped, and at most max_count commits are returned
+        (defaulting to SHORTCUT_MAX_COMMITS, unlimited if unset).
+        """
+        import pygit2
 
-    def get_commits_between_releases(self, base: str, head: str, repo_path: str = None) -> List[str]:
-        """Get commit messages between two points using local git."""
+        if max_count is None:
+            max_count = self.max_commits
         try:
-            cmd = ['git', 'log', f'{base}..{head}', '--format=%s']
-            if repo_path:
-                cmd = ['git', '-C', repo_path, 'log', f'{base}..{head}', '--format=%s']
-            logger.info(f"Running command: {' '.join(cmd)}")
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            commits = result.stdout.strip().split('\n')
-            logger.info(f"Found {len(commits)} commits between {base} and {head}")
-            return commits
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error getting commits: {e}")
-            return []
-
-    def extract_story_ids(self, commit_messages: List[str]) -> List[str]:
-        """Extract Shortcut story IDs from commit messages."""
-        story_pattern = r'sc-(\d+)'
-        story_ids = []
-        for message in commit_messages:
-            matches = re.finditer(story_pattern, message.lower())
-            story_ids.extend([f"SC-{match.group(1)}" for match in matches])
-        return list(set(story_ids))
+            repo = self._open_repository(repo_path)
+            walker = repo.walk(repo.revparse_single(head).peel(pygit2.Commit).id, pygit2.GIT_SORT_TOPOLOGICAL)
+            walker.hide(repo.revparse_single(base).peel(pygit2.Commit).id)
+        except (KeyError, ValueError, pygit2.GitError) as e:
+            logger.error(f"Error getting commits between {base} and {head}: {e}")
+            return
+        logger.info(f"Walking commits between {base} and {head}")
+        commit_count = 0
+        try:
+            for commit in walker:
+                if max_count is not None and commit_count >= max_count:
+                    break
+                if len(commit.parent_ids) > 1:
+                    continue
+                commit_count += 1
+                yield commit
+        except (KeyError, ValueError, pygit2.GitError) as e:
+            logger.error(f"Error getting commits between {base} and {head}: {e}")
+            return
+        logger.info(f"Found {commit_count} commits between {base} and {head}")
+
+    def get_story_ids_between_releases(
+        self,
+        base: str,
+        head: str,
+        repo_path: str = None,
+        max_count: int = None
+    ) -> Dict[str, str]:
+        """Extract Shortcut story IDs from commits between two points."""
+        # Like git's %s, the subject is the first paragraph with its lines joined by spaces
+        subjects = (
+            b' '.join(commit.raw_message.lstrip(b'\n').split(b'\n\n', 1)[0].splitlines())
+            for commit in self._walk_commits(base, head, repo_path, max_count)
+        )
+        return self.extract_story_ids(subjects)
+
+    def extract_story_ids(self, commit_subjects: Iterable[bytes]) -> Dict[str, str]:
+        """Extract Shortcut story IDs from raw commit subjects, in order of first appearance.
+
+        Subjects are scanned as bytes, so only the matched IDs are decoded. Each ID
+        maps to the story type implied by the Conventional Commits prefixes (feat, fix
+        or chore) of the commits referencing it, or None if none of them used one.
+        When those commits disagree, the highest ranked type in STORY_TYPES wins, so
+        a feature with a follow-up fix is still a feature.
+        """
+        story_ids = {}
+        for subject in commit_subjects:
+            type_match = COMMIT_TYPE_PATTERN.match(subject)
+            inferred_type = COMMIT_STORY_TYPES[type_match.group(1).lower()] if type_match else None
+            for match in STORY_ID_PATTERN.finditer(subject):
+                story_id = f"SC-{int(match.group(1))}"
+                current_type = story_ids.get(story_id)
+                if current_type is None or (
+                    inferred_type is not None
+                    and self.STORY_TYPES.index(inferred_type) < self.STORY_TYPES.index(current_type)
+                ):
+                    story_ids[story_id] = inferred_type
+        return story_ids
+
+    def _story_cache_path(self, story_id: str) -> Path:
+        return self.cache_dir / f"{story_id.lower().replace('sc-', '')}.json"
+
+    def read_cached_story(self, story_id: str) -> Dict:
+        """Get story details from the disk cache, or None if missing or stale."""
+        path = self._story_cache_path(story_id)
+        try:
+            if time.time() - path.stat().st_mtime < self.cache_ttl:
+                return json.loads(path.read_bytes())
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def write_cached_story(self, story_id: str, story: Dict) -> None:
+        """Store story details in the disk cache."""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._story_cache_path(story_id).write_text(json.dumps(story))
+        except OSError as e:
+            logger.warning(f"Unable to cache story {story_id}: {e}")
 
     def get_story_details(self, story_id: str) -> Dict:
         """Get story details from Shortcut API."""
+        import requests
+
+        cached = self.read_cached_story(story_id)
+        if cached is not None:
+            return cached
         try:
             numeric_id = story_id.lower().replace('sc-', '')
             logger.info(f"Fetching story details for {story_id}")
-            response = requests.get(
+            response = self.session.get(
                 f"{self.shortcut_api_url}/stories/{numeric_id}",
-                headers=self.shortcut_headers
+                headers=self.shortcut_headers,
+                timeout=10
             )
             response.raise_for_status()
-            return response.json()
+            story = response.json()
+            self.write_cached_story(story_id, story)
+            return story
         except requests.exceptions.RequestException as e:
             logger.error(f"Error fetching story {story_id}: {e}")
             return {}
 
-    def categorize_stories(self, story_ids: List[str]) -> Dict[str, List[Dict]]:
-        """Categorize stories by type."""
-        categories = {
-            'feature': [],
-            'bug': [],
-            'chore': []
-        }
-        
+    def search_stories(self, query: str) -> List[Dict]:
+        """Run a Shortcut story search, following pagination until exhausted."""
+        import requests
+
+        stories = []
+        url = f"{self.shortcut_api_url}/search/stories"
+        params = {'query': query, 'page_size': self.search_page_size, 'detail': 'full'}
+        try:
+            while url:
+                response = self.session.get(url, params=params, headers=self.shortcut_headers, timeout=10)
+                response.raise_for_status()
+                page = response.json()
+                stories.extend(page.get('data', []))
+                # 'next' is a path that already carries the query and page token
+                next_page = page.get('next')
+                url = f"{self.shortcut_base_url}{next_page}" if next_page else None
+                params = None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error searching stories with query '{query}': {e}")
+        return stories
+
+    def get_stories_bulk(self, story_ids: List[str]) -> Dict[str, Dict]:
+        """Get details for many stories using the search endpoint, keyed by story ID."""
+        stories = {}
+        missing_ids = []
         for story_id in story_ids:
-            story = self.get_story_details(story_id)
-            story_type = story.get('story_type', '').lower()
-            if story_type in categories:
+            cached = self.read_cached_story(story_id)
+            if cached is not None:
+                stories[story_id] = cached
+            else:
+                missing_ids.append(story_id)
+
+        # Normalised with int() so IDs written with leading zeros match the search results
+        numeric_ids = [int(story_id.lower().replace('sc-', '')) for story_id in missing_ids]
+        queries = [
+            ' OR '.join(f"id:{numeric_id}" for numeric_id in numeric_ids[i:i + self.search_page_size])
+            for i in range(0, len(numeric_ids), self.search_page_size)
+        ]
+        if not queries:
+            return stories
+
+        logger.info(f"Fetching details for {len(missing_ids)} stories in {len(queries)} search request(s)")
+        # Search requests are network-bound, so issue them concurrently
+        with ThreadPoolExecutor(max_workers=min(32, len(queries))) as executor:
+            results = list(executor.map(self.search_stories, queries))
+
+        for result in results:
+            for story in result:
+                story_id = f"SC-{int(story['id'])}"
+                stories[story_id] = story
+                self.write_cached_story(story_id, story)
+
+        # Search skips archived stories, so look up anything it didn't return individually
+        unresolved_ids = [story_id for story_id in missing_ids if story_id not in stories]
+        if unresolved_ids:
+            logger.info(f"Fetching {len(unresolved_ids)} stories not returned by search individually")
+            with ThreadPoolExecutor(max_workers=min(32, len(unresolved_ids))) as executor:
+                for story_id, story in zip(unresolved_ids, executor.map(self.get_story_details, unresolved_ids)):
+                    if story:
+                        stories[story_id] = story
+        return stories
+
+    def categorize_stories(self, story_ids: Dict[str, str]) -> Dict[str, List[Dict]]:
+        """Categorize stories by type.
+
+        Args:
+            story_ids: Story IDs mapped to the type inferred from their commits, or None
+                to use the story type from Shortcut.
+        """
+        categories = defaultdict(list)
+
+        # Story names are still needed from Shortcut, but only untyped stories depend on its story_type
+        stories = self.get_stories_bulk(list(story_ids))
+        for story_id, inferred_type in story_ids.items():
+            story = stories.get(story_id)
+            if not story:
+                continue
+            story_type = inferred_type or story.get('story_type')
+            if story_type in self.STORY_TYPES:
                 categories[story_type].append({
                     'id': story_id,
                     'name': story.get('name', ''),
                     'description': story.get('description', '')
                 })
-        
-        return categories
+
+        return {story_type: categories[story_type] for story_type in self.STORY_TYPES}
 
     def determine_version_bump(self, categories: Dict[str, List[Dict]]) -> str:
         """Determine version bump based on story types."""
@@ -115,55 +320,79 @@ class ReleaseHandler:
             categories: Dictionary of categorized stories
             include_story_links: If True, will include markdown links to the stories. Defaults to False.
         """
-        notes = []
-        
-        if categories['feature']:
-            notes.append("## 🚀 Features")
-            for story in categories['feature']:
-                if include_story_links:
-                    notes.append(f"- [{story['name']}](https://app.shortcut.com/story/{story['id'].lower()})")
-                else:
-                    notes.append(f"- {story['name']}")
-        
-        if categories['bug']:
-            notes.append("\n## 🐛 Bug Fixes")
-            for story in categories['bug']:
-                if include_story_links:
-                    notes.append(f"- [{story['name']}](https://app.shortcut.com/story/{story['id'].lower()})")
-                else:
-                    notes.append(f"- {story['name']}")
-        
-        if categories['chore']:
-            notes.append("\n## 🔧 Chores")
-            for story in categories['chore']:
-                if include_story_links:
-                    notes.append(f"- [{story['name']}](https://app.shortcut.com/story/{story['id'].lower()})")
-                else:
-                    notes.append(f"- {story['name']}")
-        
-        return "\n".join(notes)
+        if include_story_links:
+            format_story = lambda story: f"- [{story['name']}](https://app.shortcut.com/story/{story['id'].lower()})"
+        else:
+            format_story = lambda story: f"- {story['name']}"
+
+        sections = [
+            ("## 🚀 Features", categories['feature']),
+            ("## 🐛 Bug Fixes", categories['bug']),
+            ("## 🔧 Chores", categories['chore'])
+        ]
+        return "\n\n".join(
+            "\n".join([heading] + [format_story(story) for story in stories])
+            for heading, stories in sections
+            if stories
+        )
+
+    def get_existing_release_notes(self, tag: str) -> str:
+        """Get the release notes from an existing GitHub release for the tag, if there is one.
+
+        The action publishes the body prefix, a newline and then the generated notes,
+        so the prefix is stripped to recover the notes. Returns None if the release
+        can't be found or its body doesn't start with the expected prefix.
+        """
+        import requests
+
+        github_token = os.getenv('GITHUB_TOKEN')
+        github_repository = os.getenv('GITHUB_REPOSITORY')
+        if not github_token or not github_repository:
+            return None
+
+        github_api_url = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+        try:
+            logger.info(f"Checking for an existing release for {tag}")
+            response = self.session.get(
+                f"{github_api_url}/repos/{github_repository}/releases/tags/{tag}",
+                headers={
+                    'Accept': 'application/vnd.github+json',
+                    'Authorization': f"Bearer {github_token}"
+                },
+                timeout=10
+            )
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            body = response.json().get('body') or ''
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching release for {tag}: {e}")
+            return None
+
+        prefix = f"{os.getenv('RELEASE_BODY_PREFIX', '')}\n"
+        if not body.startswith(prefix):
+            return None
+        return body[len(prefix):].rstrip('\n')
 
     def get_current_tag(self, repo_path: str = None) -> str:
         """Get the tag at the current commit if it exists."""
+        import pygit2
+
         try:
-            cmd = ['git', 'tag', '--points-at', 'HEAD']
-            if repo_path:
-                cmd = ['git', '-C', repo_path, 'tag', '--points-at', 'HEAD']
-            logger.info(f"Running command: {' '.join(cmd)}")
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            tags = result.stdout.strip().split('\n')
-            # Filter for version tags
-            version_tags = [tag for tag in tags if re.match(r'^v[0-9]+\.[0-9]+\.[0-9]+$', tag)]
-            if version_tags:
-                logger.info(f"Found existing version tag at current commit: {version_tags[0]}")
-                return version_tags[0]
+            repo = self._open_repository(repo_path)
+            head_id = repo.head.peel(pygit2.Commit).id
+            # Filter for version tags before resolving them
+            for ref_name in sorted(repo.listall_references()):
+                if not ref_name.startswith('refs/tags/'):
+                    continue
+                tag = ref_name[len('refs/tags/'):]
+                if not VERSION_TAG_PATTERN.fullmatch(tag):
+                    continue
+                if repo.lookup_reference(ref_name).peel(pygit2.Commit).id == head_id:
+                    logger.info(f"Found existing version tag at current commit: {tag}")
+                    return tag
             return None
-        except subprocess.CalledProcessError as e:
+        except (KeyError, ValueError, pygit2.GitError) as e:
             logger.error(f"Error checking current tags: {e}")
             return None
 
@@ -180,43 +409,46 @@ def main():
         
         # Parse previous version
         try:
-            prev_version = Version(args.prev_version.lstrip('v'))
+            prev_version = parse_version(args.prev_version)
             logger.info(f"Using previous version: {args.prev_version}")
         except ValueError as e:
             logger.error(f"Invalid version format: {args.prev_version}")
             sys.exit(1)
         
-        # Get commits between releases and process story IDs
-        commit_messages = handler.get_commits_between_releases(args.prev_version, 'HEAD', args.repo_path)
-        logger.info(f"Commit messages: {commit_messages}")
-        
-        story_ids = handler.extract_story_ids(commit_messages)
-        logger.info(f"Found story IDs: {story_ids}")
-        
-        if not story_ids:
-            logger.warning("No story IDs found in commit messages")
-        
-        categories = handler.categorize_stories(story_ids)
-        logger.info(f"Categorized stories: {json.dumps(categories, indent=2)}")
-        
-        # Check if current commit already has a version tag
+        # Check if current commit already has a version tag, and whether it has already been released
         current_tag = handler.get_current_tag(args.repo_path)
-        if current_tag:
-            logger.info(f"Reusing existing tag: {current_tag}")
-            new_version = Version(current_tag.lstrip('v'))
+        release_notes = handler.get_existing_release_notes(current_tag) if current_tag else None
+
+        if release_notes is not None:
+            # Nothing to regenerate, so skip the commit scan and Shortcut lookups entirely
+            logger.info(f"Reusing existing tag and release notes: {current_tag}")
+            new_version = parse_version(current_tag)
         else:
-            # Determine new version
-            bump_type = handler.determine_version_bump(categories)
-            new_version = getattr(prev_version, f"next_{bump_type}")()
-            logger.info(f"New version: v{new_version} (bump type: {bump_type})")
-        
-        # Generate release notes
-        release_notes = handler.generate_release_notes(categories, include_story_links=args.include_story_links)
-        logger.info(f"Generated release notes: {release_notes}")
-        
+            story_ids = handler.get_story_ids_between_releases(args.prev_version, 'HEAD', args.repo_path)
+            logger.info(f"Found story IDs: {story_ids}")
+
+            if not story_ids:
+                logger.warning("No story IDs found in commit messages")
+
+            categories = handler.categorize_stories(story_ids)
+            logger.info(f"Categorized stories: {json.dumps(categories, indent=2)}")
+
+            if current_tag:
+                logger.info(f"Reusing existing tag: {current_tag}")
+                new_version = parse_version(current_tag)
+            else:
+                # Determine new version
+                bump_type = handler.determine_version_bump(categories)
+                new_version = bump_version(prev_version, bump_type)
+                logger.info(f"New version: {format_version(new_version)} (bump type: {bump_type})")
+
+            # Generate release notes
+            release_notes = handler.generate_release_notes(categories, include_story_links=args.include_story_links)
+            logger.info(f"Generated release notes: {release_notes}")
+
         # Output tag and release notes in a format that can be used by GitHub Actions
         output = {
-            "tag": f"v{new_version}",
+            "tag": format_version(new_version),
             "release_notes": release_notes
         }
         json_output = json.dumps(output)